@@ -0,0 +1,311 @@
+"""Per-merchant admission control in front of the tagger.
+
+Every request is priced up front in estimated tokens (prompt size, image
+detail and completion budget). Each tenant has a token-per-minute bucket,
+and requests share a fixed number of provider slots scheduled by weighted
+fair queuing: a request's virtual finish time is
+
+    max(virtual_time, tenant's last finish) + cost / weight
+
+and the smallest finish time runs next, so a merchant bulk-retagging their
+store only delays their own backlog. A provider-level bucket refilled at
+`provider_tpm` must also cover a ticket before it is granted, so the sum of
+tenant budgets can't exceed the provider quota.
+
+The wait is predicted from the tenant's budget, the provider bucket and the
+queue position ahead divided across `max_concurrent` slots at the observed
+call latency. If it exceeds `max_wait_s`, the request is rejected
+immediately with a retry hint instead of queueing until the client times out.
+
+Tenants come from a server-side map of API keys to merchant ids. Missing or
+unknown keys all share one "anonymous" bucket, so a client cannot mint fresh
+budgets by inventing ids or spend another merchant's budget.
+"""
+import asyncio
+import collections
+import itertools
+import json
+import math
+import os
+import statistics
+import time
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional
+
+# Vision input cost per image; "high"/"auto" assume a typical 1024px image (4 tiles)
+IMAGE_DETAIL_TOKENS = {"low": 85, "high": 765, "auto": 765}
+
+ANONYMOUS_TENANT = "anonymous"
+# How often idle tenant state is swept
+EVICTION_INTERVAL_S = 60.0
+# Smoothing for the observed provider call latency
+LATENCY_EWMA_ALPHA = 0.2
+
+
+def estimate_text_tokens(text: str) -> int:
+    # ~4 characters per token for ASCII; CJK text is closer to one token per character
+    non_ascii = sum(1 for char in text if ord(char) > 127)
+    return (len(text) - non_ascii) // 4 + non_ascii
+
+
+def estimate_request_tokens(prompt: str, image_detail: str = "auto", completion_tokens: int = 0) -> int:
+    return estimate_text_tokens(prompt) + IMAGE_DETAIL_TOKENS.get(image_detail, IMAGE_DETAIL_TOKENS["high"]) + completion_tokens
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, tenant: str, retry_after: float):
+        super().__init__(f"Tenant {tenant} is over its token budget, retry in {retry_after:.0f}s")
+        self.tenant = tenant
+        self.retry_after = retry_after
+
+
+@dataclass
+class TenantState:
+    tokens_per_minute: float
+    weight: float
+    tokens: float
+    updated: float
+    last_finish: float = 0.0
+    last_seen: float = 0.0
+    queued: int = 0
+    admitted: int = 0
+    rejected: int = 0
+    waits: Deque[float] = field(default_factory=lambda: collections.deque(maxlen=500))
+
+    def refill(self, now: float):
+        rate = self.tokens_per_minute / 60
+        self.tokens = min(self.tokens_per_minute, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def budget_wait(self, cost: float) -> float:
+        """Seconds until the bucket can cover `cost` (costs above one minute's budget wait for a full bucket)."""
+        needed = min(cost, self.tokens_per_minute)
+        return max(0.0, (needed - self.tokens) / (self.tokens_per_minute / 60))
+
+
+@dataclass(order=True)
+class _Ticket:
+    finish: float
+    seq: int
+    tenant: str = field(compare=False)
+    cost: float = field(compare=False)
+    eligible_at: float = field(compare=False)
+    enqueued: float = field(compare=False)
+    future: asyncio.Future = field(compare=False, default=None)
+    granted_at: float = field(compare=False, default=0.0)
+    wait: float = field(compare=False, default=0.0)
+
+
+class AdmissionController:
+    def __init__(self, provider_tpm: float, max_concurrent: int, default_tenant_tpm: float,
+                 tenant_tpm: Optional[Dict[str, float]] = None, tenant_weights: Optional[Dict[str, float]] = None,
+                 max_wait_s: float = 10.0, api_keys: Optional[Dict[str, str]] = None, idle_ttl_s: float = 600.0,
+                 initial_call_latency_s: float = 5.0):
+        self.provider_tpm = provider_tpm
+        self.max_concurrent = max_concurrent
+        self.default_tenant_tpm = default_tenant_tpm
+        self.tenant_tpm = tenant_tpm or {}
+        self.tenant_weights = tenant_weights or {}
+        self.max_wait_s = max_wait_s
+        # API key -> merchant id
+        self.api_keys = api_keys or {}
+        self.idle_ttl_s = idle_ttl_s
+        self.tenants: Dict[str, TenantState] = {}
+        self._last_eviction = time.monotonic()
+        self._provider_tokens = provider_tpm
+        self._provider_updated = time.monotonic()
+        # Observed seconds a granted ticket holds its slot
+        self.call_latency_s = initial_call_latency_s
+        self._queue: List[_Ticket] = []
+        self._active = 0
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        return cls(
+            provider_tpm=float(os.getenv("PROVIDER_TPM", "800000")),
+            max_concurrent=int(os.getenv("PROVIDER_MAX_CONCURRENT", "8")),
+            default_tenant_tpm=float(os.getenv("TENANT_TPM", "200000")),
+            tenant_tpm=json.loads(os.getenv("TENANT_TPM_OVERRIDES", "{}")),
+            tenant_weights=json.loads(os.getenv("TENANT_WEIGHTS", "{}")),
+            max_wait_s=float(os.getenv("ADMISSION_MAX_WAIT_S", "10")),
+            api_keys=json.loads(os.getenv("MERCHANT_API_KEYS", "{}")),
+        )
+
+    def tenant_for(self, api_key: Optional[str]) -> str:
+        """Merchant id for an API key; missing and unknown keys share the anonymous bucket."""
+        if not api_key:
+            return ANONYMOUS_TENANT
+        return self.api_keys.get(api_key, ANONYMOUS_TENANT)
+
+    def _refill_provider(self, now: float):
+        rate = self.provider_tpm / 60
+        self._provider_tokens = min(self.provider_tpm, self._provider_tokens + (now - self._provider_updated) * rate)
+        self._provider_updated = now
+
+    def _provider_wait(self, cost: float) -> float:
+        needed = min(cost, self.provider_tpm)
+        return max(0.0, (needed - self._provider_tokens) / (self.provider_tpm / 60))
+
+    def _tenant(self, tenant: str, now: float) -> TenantState:
+        state = self.tenants.get(tenant)
+        if state is None:
+            tpm = float(self.tenant_tpm.get(tenant, self.default_tenant_tpm))
+            state = TenantState(tpm, float(self.tenant_weights.get(tenant, 1.0)), tpm, now)
+            self.tenants[tenant] = state
+        state.refill(now)
+        return state
+
+    def _evict_idle(self, now: float):
+        # Idle tenants with a full bucket carry no state worth keeping
+        if now - self._last_eviction < EVICTION_INTERVAL_S:
+            return
+        self._last_eviction = now
+        for tenant, state in list(self.tenants.items()):
+            state.refill(now)
+            if state.queued == 0 and state.tokens >= state.tokens_per_minute and now - state.last_seen > self.idle_ttl_s:
+                del self.tenants[tenant]
+
+    def charge(self, tenant: str, cost: float):
+        """Deduct tokens for work that doesn't need a provider slot (e.g. batched descriptions)."""
+        now = time.monotonic()
+        state = self._tenant(tenant, now)
+        state.last_seen = now
+        state.tokens -= min(cost, state.tokens_per_minute)
+        # The provider quota is spent too, even though no slot is taken
+        self._refill_provider(now)
+        self._provider_tokens -= min(cost, self.provider_tpm)
+
+    async def acquire(self, tenant: str, cost: float):
+        """Wait for a provider slot; raises AdmissionRejected if the wait would be too long."""
+        now = time.monotonic()
+        self._evict_idle(now)
+        state = self._tenant(tenant, now)
+        state.last_seen = now
+
+        finish = max(self._virtual_time, state.last_finish) + cost / state.weight
+        ahead = [ticket for ticket in self._queue if ticket.finish <= finish]
+        # Slots: everything in flight plus what's queued ahead, drained max_concurrent at a time
+        waves = (self._active + len(ahead) - self.max_concurrent) // self.max_concurrent + 1
+        slot_wait = max(0, waves) * self.call_latency_s
+        # Provider quota: tokens ahead of us plus our own must fit the provider bucket
+        self._refill_provider(now)
+        provider_wait = self._provider_wait(sum(ticket.cost for ticket in ahead) + cost)
+        predicted_wait = state.budget_wait(cost) + max(slot_wait, provider_wait)
+        if predicted_wait > self.max_wait_s:
+            state.rejected += 1
+            raise AdmissionRejected(tenant, math.ceil(predicted_wait))
+
+        # Requests larger than a minute's budget are charged one full bucket
+        charge = min(cost, state.tokens_per_minute)
+        state.tokens -= charge
+        state.last_finish = finish
+        state.queued += 1
+        ticket = _Ticket(finish, next(self._seq), tenant, cost, now + state.budget_wait(0), now,
+                         asyncio.get_running_loop().create_future())
+        self._queue.append(ticket)
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout=self.max_wait_s)
+        except asyncio.TimeoutError:
+            self._abandon(ticket, state, charge)
+            state.rejected += 1
+            raise AdmissionRejected(tenant, math.ceil(self.max_wait_s))
+        except asyncio.CancelledError:
+            # Client went away while queued
+            self._abandon(ticket, state, charge)
+            raise
+        return ticket
+
+    def _abandon(self, ticket: _Ticket, state: TenantState, charge: float):
+        if ticket.future.done():
+            # Granted just as we gave up: undo the grant and hand the slot back
+            state.admitted -= 1
+            try:
+                state.waits.remove(ticket.wait)
+            except ValueError:
+                pass
+            self._provider_tokens += min(ticket.cost, self.provider_tpm)
+            self._active -= 1
+            self._dispatch()
+        else:
+            ticket.future.cancel()
+            self._queue.remove(ticket)
+            state.queued -= 1
+        state.tokens += charge
+
+    def release(self, ticket: _Ticket):
+        held = time.monotonic() - ticket.granted_at
+        self.call_latency_s += LATENCY_EWMA_ALPHA * (held - self.call_latency_s)
+        self._active -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        now = time.monotonic()
+        self._refill_provider(now)
+        provider_delay = None
+        while self._active < self.max_concurrent:
+            eligible = [ticket for ticket in self._queue if ticket.eligible_at <= now]
+            if not eligible:
+                break
+            ticket = min(eligible)
+            # Head of the fair queue waits for provider quota; nothing jumps past it
+            provider_delay = self._provider_wait(ticket.cost)
+            if provider_delay > 0:
+                break
+            provider_delay = None
+            self._provider_tokens -= min(ticket.cost, self.provider_tpm)
+            self._queue.remove(ticket)
+            self._virtual_time = max(self._virtual_time, ticket.finish)
+            self._active += 1
+            state = self.tenants[ticket.tenant]
+            state.queued -= 1
+            state.admitted += 1
+            ticket.granted_at = now
+            ticket.wait = now - ticket.enqueued
+            state.waits.append(ticket.wait)
+            ticket.future.set_result(None)
+
+        # Wake up when the next budget- or quota-limited request becomes eligible
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._queue and self._active < self.max_concurrent:
+            if provider_delay is not None:
+                delay = provider_delay
+            else:
+                delay = max(0.0, min(ticket.eligible_at for ticket in self._queue) - now)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def metrics(self) -> Dict:
+        """Per-tenant queue depth, wait times and remaining budget."""
+        now = time.monotonic()
+        self._refill_provider(now)
+        report = {
+            "active": self._active,
+            "queued": len(self._queue),
+            "provider_tokens_available": round(self._provider_tokens),
+            "call_latency_ms": round(self.call_latency_s * 1000, 1),
+            "tenants": {},
+        }
+        for tenant in list(self.tenants):
+            state = self._tenant(tenant, now)
+            waits = sorted(state.waits)
+            report["tenants"][tenant] = {
+                "queue_depth": state.queued,
+                "admitted": state.admitted,
+                "rejected": state.rejected,
+                "tokens_available": round(state.tokens),
+                "tokens_per_minute": state.tokens_per_minute,
+                "weight": state.weight,
+                "mean_wait_ms": round(statistics.mean(waits) * 1000, 1) if waits else None,
+                "p95_wait_ms": round(waits[int(0.95 * (len(waits) - 1))] * 1000, 1) if waits else None,
+            }
+        return report
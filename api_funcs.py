@@ -1,21 +1,34 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, HttpUrl
 from typing import Dict, Optional, Union
-import openai
+from functools import lru_cache
+import asyncio
 import json
 from datetime import datetime
 import os
+import time
 from dotenv import load_dotenv
 
+import startup_bundle
+from cascade import TagCascade
+from description_batcher import DescriptionBatcher, estimate_item_tokens
+from recorder import CallRecorder, recorder_from_env
+from admission import AdmissionController, AdmissionRejected, estimate_request_tokens
+
 # Load environment variables
 load_dotenv()
 
 # Initialize FastAPI app
 app = FastAPI()
 
-# Initialize OpenAI client
-client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# OpenAI client is created on first use so importing this module stays cheap
+@lru_cache(maxsize=None)
+def get_client():
+    import openai
+    return openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # Add CORS middleware
 app.add_middleware(
@@ -31,33 +44,55 @@ class ImageRequest(BaseModel):
     location: Optional[str] = None
 
 class OpenAIProductTagger:
-    def __init__(self):
+    def __init__(self, sys_prompt: Optional[str] = None, recorder: Optional[CallRecorder] = None):
         # Updated to use the correct model name
         self.vision_model = "gpt-4o-2024-08-06"
+        # Vision detail level; also used to price requests for admission control
+        self.image_detail = "auto"
         
-        with open("systemprompt.txt", "r") as file:
-            self.sys_prompt = file.read()
-        self.system_prompt = self.sys_prompt
+        # System prompt is read on first use (or supplied by the startup bundle)
+        self._sys_prompt = sys_prompt
+        # Optional capture of every model call for offline replay (see recorder.py)
+        self.recorder = recorder
         self.user_prompt_template = "Analyze this image and generate NEW SEO tags for it USING THE TRAINING DATA. GET THE SEO_SCORES RIGHT! GENERATE NEW TAGS IN SAME LANGUAGE as the training data. DO NOT COPY THE EXAMPLES DIRECTLY. USE TAGS THAT FOLLOW FASHION TRENDS OF THE SPECIFIC GEOGRAPHIC STYLE."
 
+    @property
+    def sys_prompt(self) -> str:
+        if self._sys_prompt is None:
+            with open(os.path.join(BASE_DIR, "systemprompt.txt"), "r") as file:
+                self._sys_prompt = file.read()
+        return self._sys_prompt
+
+    @sys_prompt.setter
+    def sys_prompt(self, value: str):
+        self._sys_prompt = value
+
+    @property
+    def config_template(self) -> str:
+        # Static parts of the prompts; recordings are grouped by its fingerprint
+        return f"{self.vision_model}\n{self.sys_prompt}\n{self.user_prompt_template}"
+
     def generate_tags(self, image_url: str, training_examples: Dict, location: str) -> Dict:
         try:
-            self.system_prompt = (
+            # Local copy: tagging runs in worker threads, so don't rely on the shared attribute
+            system_prompt = (
                 f"{self.sys_prompt}\n\n"
                 f"INFER FROM THESE EXAMPLES of GOOD and BAD SEO_SCORE tags for this item BUT DO NOT DIRECTLY COPY:\n\n{training_examples}"
             )
+            user_prompt = self.user_prompt_template + f"USE {'JAPANESE' if location == 'jp' else 'AMERICAN'} FASHION SPECIFIC TAGS THAT ARE GEOGRAPHICALLY RELEVANT."
 
-            response = client.chat.completions.create(
+            start = time.perf_counter()
+            response = get_client().chat.completions.create(
                 model=self.vision_model,
                 messages=[
-                    {"role": "system", "content": self.system_prompt},
+                    {"role": "system", "content": system_prompt},
                     {
                         "role": "user",
                         "content": [
-                            {"type": "text", "text": self.user_prompt_template + f"USE {'JAPANESE' if location == 'jp' else 'AMERICAN'} FASHION SPECIFIC TAGS THAT ARE GEOGRAPHICALLY RELEVANT."},
+                            {"type": "text", "text": user_prompt},
                             {
                                 "type": "image_url",
-                                "image_url": {"url": str(image_url)},
+                                "image_url": {"url": str(image_url), "detail": self.image_detail},
                             },
                         ],
                     }
@@ -68,6 +103,12 @@ class OpenAIProductTagger:
             )
             
             content = response.choices[0].message.content
+            if self.recorder:
+                self.recorder.record(
+                    "tags", self.vision_model,
+                    {"image_url": str(image_url), "location": location, "training_products": len(training_examples)},
+                    content, (time.perf_counter() - start) * 1000, system_prompt + user_prompt, self.config_template
+                )
             print(f"Training data: {training_examples}")  # Debug logging
             return json.loads(content)
             
@@ -82,28 +123,110 @@ class OpenAIProductTagger:
             Focus on the tags with high SEO scores (0.7 or above) to create a natural, engaging description that incorporates the key selling points. DO NOT MENTION THE SEO SCORES IN THE DESCRIPTION.
             The description should be 2-3 sentences long and maintain the cultural context of the {location.upper()} market."""
             
-            response = client.chat.completions.create(
+            start = time.perf_counter()
+            response = get_client().chat.completions.create(
                 model="gpt-4",
                 messages=[{"role": "user", "content": prompt}],
                 max_tokens=200,
                 temperature=0.7
             )
             
-            return response.choices[0].message.content
+            content = response.choices[0].message.content
+            if self.recorder:
+                self.recorder.record(
+                    "description", "gpt-4", {"tags": tags, "location": location},
+                    content, (time.perf_counter() - start) * 1000, prompt, self.config_template
+                )
+            return content
             
         except Exception as e:
             print(f"Error generating description: {str(e)}")
             raise HTTPException(status_code=500, detail=str(e))
 
+    def generate_descriptions(self, items: Dict[str, Dict], location: str) -> Dict[str, str]:
+        """Describe several products of one market in a single request.
+
+        Returns {product_id: description}; ids the model leaves out or garbles are
+        simply missing so the caller can fall back to generate_description.
+        """
+        try:
+            prompt = f"""Generate a compelling product description in {'Japanese (AND INCLUDE AN ENGLISH TRANSLATION)' if location == 'jp' else 'English'} for EACH product below, based on its SEO-optimized tags:
+            {json.dumps(items, indent=2, ensure_ascii=False)}
+            
+            Focus on the tags with high SEO scores (0.7 or above) to create a natural, engaging description that incorporates the key selling points. DO NOT MENTION THE SEO SCORES IN THE DESCRIPTION.
+            Each description should be 2-3 sentences long and maintain the cultural context of the {location.upper()} market.
+            Respond ONLY with a JSON object mapping each product id to its description string."""
+            
+            start = time.perf_counter()
+            response = get_client().chat.completions.create(
+                model="gpt-4",
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=200 * len(items),
+                temperature=0.7
+            )
+            
+            content = response.choices[0].message.content
+            if self.recorder:
+                self.recorder.record(
+                    "descriptions", "gpt-4", {"items": items, "location": location},
+                    content, (time.perf_counter() - start) * 1000, prompt, self.config_template
+                )
+            # gpt-4 has no JSON mode; tolerate prose or code fences around the object
+            descriptions = json.loads(content[content.find("{"):content.rfind("}") + 1])
+            if not isinstance(descriptions, dict):
+                return {}
+            return {
+                product_id: description
+                for product_id, description in descriptions.items()
+                if product_id in items and isinstance(description, str) and description.strip()
+            }
+            
+        except Exception as e:
+            print(f"Error generating batched descriptions: {str(e)}")
+            return {}
+
 # Initialize tagger
-tagger = OpenAIProductTagger()
+tagger = OpenAIProductTagger(recorder=recorder_from_env())
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Nearest-neighbour tier in front of the vision model, persisted in the startup bundle
+cascade = TagCascade(store=startup_bundle)
+
+# Packs concurrent description requests of the same market into one call
+description_batcher = DescriptionBatcher(tagger)
+
+# Per-merchant token budgets and fair-share scheduling of provider capacity
+admission = AdmissionController.from_env()
+
+def estimate_vision_tokens(training_data: Dict) -> int:
+    prompt = f"{tagger.sys_prompt}{training_data}{tagger.user_prompt_template}"
+    return estimate_request_tokens(prompt, tagger.image_detail, completion_tokens=2000)
+
+async def generate_tags_admitted(tenant: str, image_url: str, training_data: Dict, location: str) -> Dict:
+    # Only the vision call holds a provider slot; reject quickly rather than queueing past the client's timeout
+    try:
+        ticket = await admission.acquire(tenant, estimate_vision_tokens(training_data))
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(int(e.retry_after))})
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, tagger.generate_tags, image_url, training_data, location)
+    finally:
+        admission.release(ticket)
 
 # Load training data at startup
 @app.on_event("startup")
 async def load_training_data():
     global us_tag_history, jp_tag_history
+    # Fast path: everything precompiled into one binary bundle
+    bundle = startup_bundle.load_bundle()
+    if bundle is not None:
+        cascade.load(bundle.get("cascade_index", {}))
+    if bundle is not None and startup_bundle.is_fresh(bundle):
+        tagger.sys_prompt = bundle["system_prompt"]
+        us_tag_history = bundle["training"]["us"]
+        jp_tag_history = bundle["training"]["jp"]
+        return
+
     try:
         # Change to proper error handling with default data
         try:
@@ -139,6 +262,13 @@ async def load_training_data():
             
     except Exception as e:
         print(f"Error in load_training_data: {str(e)}")
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    cascade.save(wait=True)
+    if tagger.recorder:
+        tagger.recorder.close()
+
 # @app.post("/generate")
 # async def generate_tags_and_description(request: ImageRequest):
 #     try:
@@ -159,27 +289,50 @@ async def load_training_data():
 #         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/generate")
-async def generate_tags_and_description(request: ImageRequest):
+async def generate_tags_and_description(request: ImageRequest, x_api_key: Optional[str] = Header(None)):
     try:
         # Select training data based on location
         training_data = us_tag_history if request.location == "us" else jp_tag_history if request.location == "jp" else {}
+        tenant = admission.tenant_for(x_api_key)
+        image_url = str(request.image_url)
         
-        # Generate tags
-        tags = tagger.generate_tags(str(request.image_url), training_data, request.location)
+        # Try the local tier first (in a worker thread so concurrent requests can share description batches)
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, cascade.lookup, image_url, request.location)
+        tags = result["tags"]
+        if tags is None:
+            tags = await generate_tags_admitted(tenant, image_url, training_data, request.location)
+            # May save the index, so keep it off the event loop
+            await loop.run_in_executor(None, cascade.record_escalation, image_url, request.location, result["features"], tags)
         
         # Generate description based on the tags
-        description = tagger.generate_description(tags, request.location)
+        admission.charge(tenant, estimate_item_tokens(tags))
+        description = await description_batcher.describe(tags, request.location)
         
         return {
             "tags": tags,
             "description": description,
-            "location": request.location
+            "location": request.location,
+            "tier": result["tier"],
+            "confidence": result["confidence"]
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in generate endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Escalation rate of the tagging cascade per market
+@app.get("/cascade/stats")
+async def cascade_stats():
+    return cascade.report()
+
+# Per-merchant queue depth, wait times and remaining token budget
+@app.get("/admission/stats")
+async def admission_stats():
+    return admission.metrics()
+
 # Health check endpoint
 @app.get("/health")
 async def health_check():
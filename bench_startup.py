@@ -0,0 +1,66 @@
+"""Cold-start benchmark for the tagging API.
+
+Runs `import api_funcs` plus the startup event in fresh interpreters, the
+same work a new container does before serving its first request, and fails
+if the median exceeds the budget:
+
+    python bench_startup.py --runs 10 --budget-ms 800
+
+Interpreter startup itself is measured separately and subtracted.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "800"))
+
+STARTUP_SNIPPET = "import asyncio, api_funcs; asyncio.run(api_funcs.load_training_data())"
+
+
+class StartupFailed(Exception):
+    pass
+
+
+def _time_snippet(snippet: str, runs: int) -> float:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", snippet], cwd=BASE_DIR, capture_output=True, text=True)
+        timings.append((time.perf_counter() - start) * 1000)
+        if result.returncode != 0:
+            raise StartupFailed(result.stderr.strip())
+    return statistics.median(timings)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the startup bundle first")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        import startup_bundle
+        startup_bundle.write_bundle(startup_bundle.build_bundle())
+
+    try:
+        baseline_ms = _time_snippet("pass", args.runs)
+        startup_ms = _time_snippet(STARTUP_SNIPPET, args.runs) - baseline_ms
+    except StartupFailed as e:
+        print(f"Startup failed:\n{e}")
+        return 1
+
+    print(f"Interpreter baseline: {baseline_ms:.1f} ms")
+    print(f"Cold start (median of {args.runs}): {startup_ms:.1f} ms, budget {args.budget_ms:.1f} ms")
+    if startup_ms > args.budget_ms:
+        print("Startup time regression: over budget")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,309 @@
+"""Cheap nearest-neighbour tagging in front of the vision model.
+
+Many products are close variants of items we have already tagged. The first
+tier computes small local image features (an 8x8 average hash plus a coarse
+colour histogram) and looks up the most similar already-tagged product for
+the same market. If it is similar enough, its tags are reused; otherwise the
+request escalates to `OpenAIProductTagger.generate_tags` and the result is
+added to the index so the next variant can be served locally.
+
+Pillow is optional. Without it (or when an image cannot be fetched) every
+request escalates, which is the same behaviour as before the cascade.
+
+Image URLs come from clients, so `fetch_image` only talks to public http(s)
+hosts, pins the connection to the address it checked, does not follow
+redirects and caps the download size.
+"""
+import copy
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import ssl
+import threading
+import time
+import urllib.parse
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+HASH_SIZE = 8
+HIST_BINS = 4  # per channel -> 64 histogram bins
+
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+MAX_IMAGE_PIXELS = 40_000_000
+
+
+@dataclass
+class CascadeConfig:
+    enabled: bool = True
+    # Minimum similarity (0-1) for the local tier to answer on its own
+    confidence_threshold: float = 0.92
+    fetch_timeout: float = 3.0
+    # Oldest entries are dropped past this size
+    max_entries: int = 5000
+
+
+def default_configs() -> Dict[str, CascadeConfig]:
+    """Per-market configs, overridable via CASCADE_<MARKET>_ENABLED / _THRESHOLD."""
+    configs = {}
+    for market in ("us", "jp"):
+        prefix = f"CASCADE_{market.upper()}"
+        configs[market] = CascadeConfig(
+            enabled=os.getenv(f"{prefix}_ENABLED", "1") not in ("0", "false", "False"),
+            confidence_threshold=float(os.getenv(f"{prefix}_THRESHOLD", "0.92")),
+        )
+    return configs
+
+
+def _public_address(host: str, port: int) -> str:
+    """Resolve `host` and return an address, refusing private, loopback and link-local ones."""
+    addresses = {info[4][0] for info in socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)}
+    if not addresses:
+        raise ValueError(f"Could not resolve {host}")
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split("%")[0])
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"Refusing to fetch from non-public address {address}")
+    return sorted(addresses)[0]
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    # Connect to the address we validated so DNS can't change between check and use
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, **kwargs)
+        self._address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self._address, self.port), self.timeout)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, context=ssl.create_default_context(), **kwargs)
+        self._address = address
+
+    def connect(self):
+        sock = socket.create_connection((self._address, self.port), self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def fetch_image(image_url: str, timeout: float, max_bytes: int = MAX_IMAGE_BYTES) -> bytes:
+    parsed = urllib.parse.urlsplit(image_url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError(f"Unsupported image URL scheme: {parsed.scheme}")
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    address = _public_address(parsed.hostname, port)
+
+    connection_class = _PinnedHTTPSConnection if parsed.scheme == "https" else _PinnedHTTPConnection
+    connection = connection_class(parsed.hostname, address, port=port, timeout=timeout)
+    try:
+        path = parsed.path or "/"
+        if parsed.query:
+            path = f"{path}?{parsed.query}"
+        connection.request("GET", path, headers={"Accept": "image/*"})
+        response = connection.getresponse()
+        # Redirects are not followed; they could point at internal hosts
+        if response.status != 200:
+            raise ValueError(f"Image fetch returned HTTP {response.status}")
+        length = response.getheader("Content-Length")
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise ValueError(f"Image is larger than {max_bytes} bytes")
+        data = response.read(max_bytes + 1)
+        if len(data) > max_bytes:
+            raise ValueError(f"Image is larger than {max_bytes} bytes")
+        return data
+    finally:
+        connection.close()
+
+
+def image_features(image_bytes: bytes) -> Optional[Tuple[int, List[float]]]:
+    """Return (average hash, normalised colour histogram), or None without Pillow."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+
+    # Pillow raises DecompressionBombError past twice this limit; check the header size too
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        width, height = img.size
+        if width * height > MAX_IMAGE_PIXELS:
+            raise ValueError(f"Image is too large: {width}x{height}")
+        img.draft("RGB", (64, 64))
+        img = img.convert("RGB")
+        img.thumbnail((64, 64))
+
+        grey = list(img.convert("L").resize((HASH_SIZE, HASH_SIZE)).getdata())
+        mean = sum(grey) / len(grey)
+        avg_hash = 0
+        for pixel in grey:
+            avg_hash = (avg_hash << 1) | (1 if pixel >= mean else 0)
+
+        hist = [0.0] * (HIST_BINS ** 3)
+        step = 256 // HIST_BINS
+        pixels = list(img.getdata())
+        for r, g, b in pixels:
+            hist[(r // step) * HIST_BINS * HIST_BINS + (g // step) * HIST_BINS + b // step] += 1
+        total = float(len(pixels))
+        hist = [count / total for count in hist]
+
+    return avg_hash, hist
+
+
+def hash_similarity(a: int, b: int) -> float:
+    return 1 - bin(a ^ b).count("1") / (HASH_SIZE * HASH_SIZE)
+
+
+def similarity(a: Tuple[int, List[float]], b: Tuple[int, List[float]]) -> float:
+    """Blend of hash agreement and histogram intersection, both in 0-1."""
+    hist_sim = sum(min(x, y) for x, y in zip(a[1], b[1]))
+    return 0.5 * hash_similarity(a[0], b[0]) + 0.5 * hist_sim
+
+
+@dataclass
+class NeighbourIndex:
+    """Already-tagged products for one market, searched by brute force.
+
+    `entries` is replaced rather than mutated on every add, so `nearest` can
+    search a snapshot without holding the cascade lock.
+    """
+    max_entries: int = 5000
+    entries: List[Dict] = field(default_factory=list)
+
+    def add(self, product_id: str, features: Tuple[int, List[float]], tags: Dict) -> bool:
+        """Index a product; returns False if it is already indexed."""
+        if any(entry["product_id"] == product_id for entry in self.entries):
+            return False
+        entry = {"product_id": product_id, "hash": features[0], "hist": features[1], "tags": tags}
+        self.entries = (self.entries + [entry])[-self.max_entries:]
+        return True
+
+    def merge(self, others: List[Dict]):
+        """Add entries saved by other replicas, keeping ours for products both have indexed."""
+        known = {entry["product_id"] for entry in self.entries}
+        extra = [entry for entry in others if entry["product_id"] not in known]
+        self.entries = (extra + self.entries)[-self.max_entries:]
+
+    def nearest(self, features: Tuple[int, List[float]], min_score: float = 0.0) -> Tuple[float, Optional[Dict]]:
+        """Best match scoring at least `min_score`; histograms are only compared when the hash allows it."""
+        best_score, best = min_score, None
+        for entry in self.entries:
+            hash_sim = hash_similarity(features[0], entry["hash"])
+            # Histogram similarity is at most 1, so this bounds the blended score
+            if 0.5 * hash_sim + 0.5 < best_score:
+                continue
+            score = 0.5 * hash_sim + 0.5 * sum(min(x, y) for x, y in zip(features[1], entry["hist"]))
+            if score >= best_score:
+                best_score, best = score, entry
+        return (best_score, best) if best is not None else (0.0, None)
+
+
+class TagCascade:
+    """Serve tags from the local tier when confident, otherwise let the caller escalate.
+
+    The vision call itself happens outside the cascade so the caller can wrap
+    just that call in admission control; it reports the result back through
+    `record_escalation`.
+    """
+
+    def __init__(self, configs: Optional[Dict[str, CascadeConfig]] = None, store=None,
+                 save_every: Optional[int] = None):
+        self.configs = configs if configs is not None else default_configs()
+        self.indexes = {market: NeighbourIndex(config.max_entries) for market, config in self.configs.items()}
+        self.stats = {market: {"local": 0, "escalated": 0} for market in self.configs}
+        self._lock = threading.Lock()
+        # Anything with read_cascade_index() / write_cascade_index(data), e.g. the startup_bundle module
+        self.store = store
+        # Containers are often killed without a clean shutdown, so save as we learn
+        self.save_every = save_every or int(os.getenv("CASCADE_SAVE_EVERY", "20"))
+        self._unsaved = 0
+        self._save_lock = threading.Lock()
+
+    def _features_for(self, image_url: str, config: CascadeConfig):
+        try:
+            return image_features(fetch_image(image_url, config.fetch_timeout))
+        except Exception as e:
+            print(f"Cascade could not compute image features: {str(e)}")
+            return None
+
+    def lookup(self, image_url: str, location: str) -> Dict:
+        """Return {"tags", "tier", "confidence", "features", "latency_ms"}; tags is None when the item must escalate."""
+        start = time.perf_counter()
+        config = self.configs.get(location)
+        features = self._features_for(image_url, config) if config and config.enabled else None
+
+        tags, tier, confidence = None, "vision", 0.0
+        if features is not None:
+            confidence, match = self.indexes[location].nearest(features, config.confidence_threshold)
+            if match is not None:
+                self._count(location, "local")
+                tags, tier = copy.deepcopy(match["tags"]), "local"
+        return {
+            "tags": tags,
+            "tier": tier,
+            "confidence": round(confidence, 4),
+            "features": features,
+            "latency_ms": round((time.perf_counter() - start) * 1000, 2),
+        }
+
+    def record_escalation(self, image_url: str, location: str, features, tags: Dict):
+        """Count an escalated item and index its vision tags for future variants."""
+        save_now = False
+        if features is not None and isinstance(tags, dict) and location in self.indexes:
+            with self._lock:
+                # Concurrent escalations of the same URL index it once
+                if self.indexes[location].add(image_url, features, tags):
+                    self._unsaved += 1
+                    save_now = self.store is not None and self._unsaved >= self.save_every
+        self._count(location, "escalated")
+        if save_now:
+            self.save()
+
+    def _count(self, location: str, tier: str):
+        if location in self.stats:
+            with self._lock:
+                self.stats[location][tier] += 1
+
+    def report(self) -> Dict:
+        """Per-market request counts and escalation rate."""
+        report = {}
+        with self._lock:
+            for market, counts in self.stats.items():
+                total = counts["local"] + counts["escalated"]
+                report[market] = {
+                    **counts,
+                    "indexed_products": len(self.indexes[market].entries),
+                    "escalation_rate": counts["escalated"] / total if total else None,
+                }
+        return report
+
+    def save(self, wait: bool = False):
+        """Merge in what other replicas saved, then write the index back to the store."""
+        if self.store is None:
+            return
+        # One save at a time; unless asked to wait, skip if one is already running
+        if not self._save_lock.acquire(blocking=wait):
+            return
+        try:
+            stored = self.store.read_cascade_index()
+            with self._lock:
+                for market, entries in stored.items():
+                    if market in self.indexes:
+                        self.indexes[market].merge(entries)
+                self._unsaved = 0
+            self.store.write_cascade_index(self.snapshot())
+        except Exception as e:
+            print(f"Error saving cascade index: {str(e)}")
+        finally:
+            self._save_lock.release()
+
+    def snapshot(self) -> Dict[str, List[Dict]]:
+        with self._lock:
+            return {market: index.entries for market, index in self.indexes.items()}
+
+    def load(self, data: Dict[str, List[Dict]]):
+        with self._lock:
+            for market, entries in data.items():
+                if market in self.indexes:
+                    self.indexes[market].entries = list(entries)[-self.indexes[market].max_entries:]
@@ -0,0 +1,108 @@
+"""Micro-batching for product descriptions.
+
+Each description is a small text-only prompt, so under bulk load most of the
+cost is per-request overhead. `DescriptionBatcher` holds requests for a few
+milliseconds, packs the tag sets of up to `max_batch_size` products from the
+same market into one `generate_descriptions` call and resolves every waiting
+caller with its own description. Products the model leaves out of the batched
+response fall back to a single `generate_description` call.
+
+Batches are also capped by estimated tokens (tag JSON plus each product's
+200-token completion) so a batch of large JP tag sets stays inside the
+description model's context window.
+"""
+import asyncio
+import json
+import os
+import uuid
+from typing import Dict, List, Optional, Set, Tuple
+
+from admission import estimate_text_tokens
+
+# Completion budget per product, matching generate_description's max_tokens
+DESCRIPTION_COMPLETION_TOKENS = 200
+# Instructions around the packed tag sets
+BATCH_PROMPT_OVERHEAD_TOKENS = 300
+
+
+def estimate_item_tokens(tags: Dict) -> int:
+    return estimate_text_tokens(json.dumps(tags, indent=2, ensure_ascii=False)) + DESCRIPTION_COMPLETION_TOKENS
+
+
+class DescriptionBatcher:
+    def __init__(self, tagger, max_batch_size: Optional[int] = None, max_wait_ms: Optional[float] = None,
+                 max_batch_tokens: Optional[int] = None):
+        self.tagger = tagger
+        self.max_batch_size = max_batch_size or int(os.getenv("DESCRIPTION_BATCH_SIZE", "8"))
+        self.max_wait_ms = max_wait_ms if max_wait_ms is not None else float(os.getenv("DESCRIPTION_BATCH_WAIT_MS", "20"))
+        # Prompt plus completion; gpt-4 has an 8k context
+        self.max_batch_tokens = max_batch_tokens or int(os.getenv("DESCRIPTION_BATCH_TOKENS", "7000"))
+        # market -> [(product_id, tags, future)] and its estimated token total
+        self._pending: Dict[str, List[Tuple[str, Dict, asyncio.Future]]] = {}
+        self._pending_tokens: Dict[str, int] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        # Strong references so running batches aren't garbage-collected
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def describe(self, tags: Dict, location: str, product_id: Optional[str] = None) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        product_id = product_id or uuid.uuid4().hex[:12]
+        item_tokens = estimate_item_tokens(tags)
+
+        # Send what is queued first if this product would push the batch past its token budget
+        pending_tokens = self._pending_tokens.get(location, BATCH_PROMPT_OVERHEAD_TOKENS)
+        if location in self._pending and pending_tokens + item_tokens > self.max_batch_tokens:
+            self._flush(location)
+            pending_tokens = BATCH_PROMPT_OVERHEAD_TOKENS
+
+        pending = self._pending.setdefault(location, [])
+        pending.append((product_id, tags, future))
+        self._pending_tokens[location] = pending_tokens + item_tokens
+
+        if len(pending) >= self.max_batch_size or self._pending_tokens[location] >= self.max_batch_tokens:
+            self._flush(location)
+        elif location not in self._timers:
+            self._timers[location] = loop.call_later(self.max_wait_ms / 1000, self._flush, location)
+        return await future
+
+    def _flush(self, location: str):
+        timer = self._timers.pop(location, None)
+        if timer is not None:
+            timer.cancel()
+        self._pending_tokens.pop(location, None)
+        batch = self._pending.pop(location, [])
+        if batch:
+            task = asyncio.ensure_future(self._run_batch(batch, location))
+            self._tasks.add(task)
+            task.add_done_callback(self._batch_done)
+
+    def _batch_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error in description batch: {str(task.exception())}")
+
+    async def _run_batch(self, batch: List[Tuple[str, Dict, asyncio.Future]], location: str):
+        loop = asyncio.get_running_loop()
+        # Duplicate ids would collide in the response mapping, so key by position
+        items = {f"{index}_{product_id}": tags for index, (product_id, tags, _) in enumerate(batch)}
+
+        descriptions: Dict[str, str] = {}
+        if len(batch) > 1:
+            try:
+                descriptions = await loop.run_in_executor(None, self.tagger.generate_descriptions, items, location)
+            except Exception as e:
+                print(f"Error in batched descriptions, falling back to single calls: {str(e)}")
+
+        async def resolve(key: str, tags: Dict, future: asyncio.Future):
+            try:
+                description = descriptions.get(key)
+                if description is None:
+                    description = await loop.run_in_executor(None, self.tagger.generate_description, tags, location)
+                if not future.done():
+                    future.set_result(description)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+
+        await asyncio.gather(*(resolve(key, tags, future) for key, (_, tags, future) in zip(items, batch)))
@@ -0,0 +1,100 @@
+"""Capture model calls to a compressed local archive for offline evaluation.
+
+Every `generate_tags` / `generate_description(s)` call is appended as one
+JSON line to a gzip archive. Each line carries a `config` label, so archives
+recorded with different prompts or models can be compared later by
+`replay.py` without paying for new live calls. Without RECORD_CONFIG the
+label is a fingerprint of the static prompt template (model, system prompt,
+user prompt), not of the filled-in prompt, so every call made under one
+configuration shares a label.
+
+Enable it with:
+
+    RECORD_CALLS_PATH=recordings/baseline.jsonl.gz RECORD_CONFIG=baseline uvicorn api_funcs:app
+"""
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from typing import Dict, Iterator, Optional
+
+
+def prompt_fingerprint(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+
+class CallRecorder:
+    def __init__(self, path: str, config: Optional[str] = None):
+        self.path = path
+        self.config = config
+        self._lock = threading.Lock()
+        self._file = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def record(self, kind: str, model: str, request: Dict, response, latency_ms: float, prompt: str = "",
+               template: str = ""):
+        """Append one call; `response` is the raw model output so invalid JSON is kept too."""
+        fingerprint = prompt_fingerprint(template)
+        entry = {
+            "kind": kind,
+            "config": self.config or f"template:{fingerprint}",
+            "model": model,
+            "template_sha": fingerprint,
+            "prompt_chars": len(prompt),
+            "ts": time.time(),
+            "latency_ms": round(latency_ms, 1),
+            "request": request,
+            "response": response,
+        }
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+        try:
+            with self._lock:
+                # One gzip member per process run; gzip.open reads appended members back as one stream
+                if self._file is None:
+                    self._file = gzip.open(self.path, "at", encoding="utf-8")
+                self._file.write(line)
+                # Sync-flush so a crash loses at most the current line
+                self._file.flush()
+        except Exception as e:
+            print(f"Error recording call: {str(e)}")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def recorder_from_env() -> Optional[CallRecorder]:
+    path = os.getenv("RECORD_CALLS_PATH")
+    if not path:
+        return None
+    return CallRecorder(path, os.getenv("RECORD_CONFIG"))
+
+
+def read_archive(path: str) -> Iterator[Dict]:
+    """Yield recorded calls, tolerating an archive whose writer is still open or crashed."""
+    with open(path, "rb") as file:
+        data = file.read()
+
+    # Decompress member by member; the last one may lack its end-of-stream marker
+    text = b""
+    while data:
+        decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        text += decompressor.decompress(data)
+        data = decompressor.unused_data
+
+    for line in text.decode("utf-8", errors="replace").splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            # Partially flushed final line
+            continue
@@ -0,0 +1,229 @@
+"""Offline evaluation of recorded model calls.
+
+Scores archives written by `recorder.py` without any live API calls, so a
+cheaper prompt or smaller model can be judged against the current one:
+
+    python replay.py recordings/baseline.jsonl.gz recordings/short_prompt.jsonl.gz --reference baseline
+
+Calls are grouped by their `config` label and every configuration is scored
+in chunks spread over all cores. Per configuration it reports:
+
+- validation_failure_rate: responses that are not valid tag JSON
+- tag_overlap: mean Jaccard overlap with the reference config for the same image and market
+- score_error: mean absolute error of seo_score against the calibrated
+  scores in training_us.json / training_jp.json, for tags that appear there
+- latency and prompt size per call kind (tags, description, batched
+  descriptions), to weigh quality against cost
+"""
+import argparse
+import collections
+import json
+import math
+import os
+import statistics
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from recorder import read_archive
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SCORE_FIELDS = ("seo_score", "buy_rate", "click_rate")
+CALL_KINDS = ("tags", "description", "descriptions")
+
+
+def load_calibration(base_dir: str = BASE_DIR) -> Dict[str, Dict[str, float]]:
+    """Mean calibrated seo_score per lowercased tag name, per market."""
+    calibration = {}
+    for market in ("us", "jp"):
+        scores: Dict[str, List[float]] = {}
+        try:
+            with open(os.path.join(base_dir, f"training_{market}.json"), "r") as file:
+                history = json.load(file)
+        except Exception as e:
+            print(f"Error loading {market.upper()} training data: {str(e)}")
+            history = {}
+        for groups in history.values():
+            for group in groups.values():
+                for tag_name, values in group.items():
+                    scores.setdefault(tag_name.lower(), []).append(values["seo_score"])
+        calibration[market] = {tag: statistics.mean(values) for tag, values in scores.items()}
+    return calibration
+
+
+def parse_tags(raw) -> Optional[Dict]:
+    if isinstance(raw, dict):
+        return raw
+    try:
+        tags = json.loads(raw)
+    except (TypeError, ValueError):
+        return None
+    return tags if isinstance(tags, dict) else None
+
+
+def validate_tags(tags: Optional[Dict]) -> bool:
+    """Same shape as systemprompt.txt asks for: product -> group -> tag -> scores in 0-1."""
+    if not tags:
+        return False
+    for groups in tags.values():
+        if not isinstance(groups, dict) or not groups:
+            return False
+        for group in groups.values():
+            if not isinstance(group, dict):
+                return False
+            for values in group.values():
+                if not isinstance(values, dict):
+                    return False
+                for score_field in SCORE_FIELDS:
+                    score = values.get(score_field)
+                    if not isinstance(score, (int, float)) or not 0 <= score <= 1:
+                        return False
+    return True
+
+
+def flatten_tags(tags: Dict) -> Dict[str, float]:
+    flat = {}
+    for groups in tags.values():
+        for group in groups.values():
+            for tag_name, values in group.items():
+                flat[tag_name.lower()] = values["seo_score"]
+    return flat
+
+
+def _key(record: Dict) -> Tuple[str, str]:
+    return record["request"].get("image_url"), record["request"].get("location")
+
+
+def score_chunk(records: List[Dict], reference: Dict[Tuple[str, str], Dict[str, float]],
+                calibration: Dict[str, Dict[str, float]]) -> Dict[str, float]:
+    """Partial sums for a slice of one config's records; merged by `finalize`."""
+    sums = dict.fromkeys(("tag_calls", "description_calls", "failures", "overlap_sum", "overlap_count",
+                          "error_sum", "error_count"), 0.0)
+    for record in records:
+        # Vision and text calls differ by orders of magnitude, so keep them apart
+        kind = record["kind"]
+        sums[f"calls:{kind}"] = sums.get(f"calls:{kind}", 0.0) + 1
+        sums[f"latency_sum:{kind}"] = sums.get(f"latency_sum:{kind}", 0.0) + record["latency_ms"]
+        sums[f"prompt_chars_sum:{kind}"] = sums.get(f"prompt_chars_sum:{kind}", 0.0) + record["prompt_chars"]
+        if record["kind"] != "tags":
+            sums["description_calls"] += 1
+            continue
+
+        sums["tag_calls"] += 1
+        tags = parse_tags(record["response"])
+        if not validate_tags(tags):
+            sums["failures"] += 1
+            continue
+        flat = flatten_tags(tags)
+
+        reference_tags = reference.get(_key(record))
+        if reference_tags is not None:
+            union = set(flat) | set(reference_tags)
+            sums["overlap_sum"] += len(set(flat) & set(reference_tags)) / len(union) if union else 1.0
+            sums["overlap_count"] += 1
+
+        market_calibration = calibration.get(record["request"].get("location"), {})
+        for tag, score in flat.items():
+            if tag in market_calibration:
+                sums["error_sum"] += abs(score - market_calibration[tag])
+                sums["error_count"] += 1
+    return sums
+
+
+def finalize(config: str, sums: Dict[str, float]) -> Dict:
+    def ratio(total, count):
+        return round(total / count, 4) if count else None
+
+    return {
+        "config": config,
+        "tag_calls": int(sums["tag_calls"]),
+        "description_calls": int(sums["description_calls"]),
+        "validation_failure_rate": ratio(sums["failures"], sums["tag_calls"]),
+        "tag_overlap": ratio(sums["overlap_sum"], sums["overlap_count"]),
+        "score_error": ratio(sums["error_sum"], sums["error_count"]),
+        "calibrated_tags": int(sums["error_count"]),
+        "latency_ms": {kind: ratio(sums.get(f"latency_sum:{kind}", 0), sums.get(f"calls:{kind}", 0)) for kind in CALL_KINDS},
+        "prompt_chars": {kind: ratio(sums.get(f"prompt_chars_sum:{kind}", 0), sums.get(f"calls:{kind}", 0)) for kind in CALL_KINDS},
+    }
+
+
+# Shared read-only state, sent to each worker once via the pool initializer
+_worker_state: Dict = {}
+
+
+def _init_worker(reference, calibration):
+    _worker_state["reference"] = reference
+    _worker_state["calibration"] = calibration
+
+
+def _score_job(job):
+    config, records = job
+    return config, score_chunk(records, _worker_state["reference"], _worker_state["calibration"])
+
+
+def build_reference(records: List[Dict]) -> Dict[Tuple[str, str], Dict[str, float]]:
+    reference = {}
+    for record in records:
+        if record["kind"] != "tags" or _key(record) in reference:
+            continue
+        tags = parse_tags(record["response"])
+        if validate_tags(tags):
+            reference[_key(record)] = flatten_tags(tags)
+    return reference
+
+
+def replay(archives: List[str], reference_config: Optional[str] = None, workers: Optional[int] = None) -> List[Dict]:
+    by_config: Dict[str, List[Dict]] = {}
+    for path in archives:
+        for record in read_archive(path):
+            by_config.setdefault(record["config"], []).append(record)
+    if not by_config:
+        return []
+
+    reference_config = reference_config or next(iter(by_config))
+    if reference_config not in by_config:
+        raise ValueError(f"Reference config {reference_config!r} not found in archives")
+    reference = build_reference(by_config[reference_config])
+    calibration = load_calibration()
+
+    # Split every config into chunks so all cores are busy even when comparing two configs
+    workers = workers or os.cpu_count() or 1
+    total = sum(len(records) for records in by_config.values())
+    chunk_size = max(1, math.ceil(total / (workers * 4)))
+    jobs = [
+        (config, records[start:start + chunk_size])
+        for config, records in by_config.items()
+        for start in range(0, len(records), chunk_size)
+    ]
+
+    merged = {config: collections.Counter() for config in by_config}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(reference, calibration)) as pool:
+        for config, sums in pool.map(_score_job, jobs):
+            merged[config].update(sums)
+    return [finalize(config, sums) for config, sums in merged.items()]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Score recorded model calls offline.")
+    parser.add_argument("archives", nargs="+")
+    parser.add_argument("--reference", help="config label to measure tag overlap against (default: first seen)")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = replay(args.archives, args.reference, args.workers)
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+        return 0
+
+    columns = ["config", "tag_calls", "validation_failure_rate", "tag_overlap", "score_error"]
+    per_kind = [(metric, kind) for metric in ("latency_ms", "prompt_chars") for kind in CALL_KINDS]
+    print("\t".join(columns + [f"{kind}_{metric}" for metric, kind in per_kind]))
+    for result in results:
+        print("\t".join([str(result[column]) for column in columns] +
+                        [str(result[metric][kind]) for metric, kind in per_kind]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
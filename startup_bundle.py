@@ -0,0 +1,123 @@
+"""Precompiled startup bundle for the tagging API.
+
+Parsing the training JSON, reading the system prompt and loading the
+cascade's neighbour index on every cold start adds latency to the first
+requests a fresh container serves. This module packs all three into one
+pickled file that `api_funcs` loads in a single read. Build it as part of
+the image:
+
+    python startup_bundle.py
+
+The neighbour index is the bulk of the bundle (up to 5000 entries per
+market). The cascade writes it back through `write_cascade_index` as it
+learns, so the bundle is refreshed whenever the index is saved.
+
+The bundle records the mtime and size of the prompt and training files; if
+any of them change, `is_fresh` fails and the API reads those sources
+directly. The neighbour index is still used from a stale bundle, and the
+next index save rebuilds the rest of it.
+"""
+import os
+import pickle
+from typing import Dict, Optional
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BUNDLE_PATH = os.path.join(BASE_DIR, "startup_bundle.bin")
+BUNDLE_VERSION = 3
+
+SOURCE_FILES = {
+    "system_prompt": "systemprompt.txt",
+    "us": "training_us.json",
+    "jp": "training_jp.json",
+}
+
+
+def _source_stamp(base_dir: str) -> Dict:
+    # Cheap staleness check: stat the sources instead of hashing them
+    stamp = {}
+    for name in SOURCE_FILES.values():
+        try:
+            st = os.stat(os.path.join(base_dir, name))
+            stamp[name] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stamp[name] = None
+    return stamp
+
+
+def build_bundle(base_dir: str = BASE_DIR, cascade_index: Optional[Dict] = None) -> Dict:
+    import json
+
+    with open(os.path.join(base_dir, SOURCE_FILES["system_prompt"]), "r") as file:
+        system_prompt = file.read()
+
+    training = {}
+    for market in ("us", "jp"):
+        with open(os.path.join(base_dir, SOURCE_FILES[market]), "r") as file:
+            training[market] = json.load(file)
+
+    return {
+        "version": BUNDLE_VERSION,
+        "sources": _source_stamp(base_dir),
+        "system_prompt": system_prompt,
+        "training": training,
+        "cascade_index": cascade_index or {},
+    }
+
+
+def write_bundle(bundle: Dict, path: str = BUNDLE_PATH) -> None:
+    # Write to a per-process temp file first so a half-written bundle is never loaded
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        pickle.dump(bundle, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_bundle(path: str = BUNDLE_PATH) -> Optional[Dict]:
+    """Load the bundle, or return None if it is missing, unreadable or from another version."""
+    try:
+        with open(path, "rb") as file:
+            bundle = pickle.load(file)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Error loading startup bundle: {str(e)}")
+        return None
+
+    if not isinstance(bundle, dict):
+        print("Startup bundle is not a dict, ignoring it")
+        return None
+    if bundle.get("version") != BUNDLE_VERSION:
+        print("Startup bundle version mismatch, ignoring it")
+        return None
+    return bundle
+
+
+def is_fresh(bundle: Dict, base_dir: str = BASE_DIR) -> bool:
+    """True if the prompt and training data in the bundle match the source files."""
+    return "training" in bundle and bundle.get("sources") == _source_stamp(base_dir)
+
+
+def read_cascade_index(path: str = BUNDLE_PATH) -> Dict:
+    bundle = load_bundle(path)
+    return bundle.get("cascade_index", {}) if bundle else {}
+
+
+def write_cascade_index(cascade_index: Dict, path: str = BUNDLE_PATH, base_dir: str = BASE_DIR) -> None:
+    """Store the neighbour index, rebuilding the rest of the bundle if it is missing or stale."""
+    bundle = load_bundle(path)
+    if bundle is None or not is_fresh(bundle, base_dir):
+        try:
+            bundle = build_bundle(base_dir)
+        except Exception as e:
+            print(f"Error rebuilding startup bundle: {str(e)}")
+            # Keep just the index; without sources the bundle never counts as fresh
+            bundle = {"version": BUNDLE_VERSION, "sources": None}
+    bundle["cascade_index"] = cascade_index
+    write_bundle(bundle, path)
+
+
+if __name__ == "__main__":
+    # Keep whatever the cascade has learned so far
+    bundle = build_bundle(cascade_index=read_cascade_index())
+    write_bundle(bundle)
+    print(f"Wrote {BUNDLE_PATH} ({os.path.getsize(BUNDLE_PATH)} bytes)")